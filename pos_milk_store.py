@@ -1,14 +1,17 @@
 import os
 import re
-from datetime import datetime
+import threading
+from itertools import islice
 import tkinter as tk
 from tkinter import messagebox, simpledialog
 from sqlalchemy import (
     create_engine, Column, Integer, String, Float,
-    ForeignKey, DateTime, inspect, text
+    ForeignKey, DateTime, inspect, text, event, insert
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.pool import SingletonThreadPool
 import ttkbootstrap as tb
 
 # ───── Database / ORM Setup ─────
@@ -17,8 +20,22 @@ DB_PATH     = os.path.join(BASE_DIR, 'shop.db')
 RECEIPT_DIR = os.path.join(BASE_DIR, 'receipts')
 os.makedirs(RECEIPT_DIR, exist_ok=True)
 
-engine  = create_engine(f'sqlite:///{DB_PATH}', echo=False)
+engine  = create_engine(f'sqlite:///{DB_PATH}', echo=False,
+                        poolclass=SingletonThreadPool,
+                        connect_args={"check_same_thread": False})
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-20000")
+    cur.close()
+
 Session = sessionmaker(bind=engine)
+# long-lived session for Tk main-thread reads; writes use a short-lived Session()
+ReadSession = scoped_session(Session)
 Base    = declarative_base()
 
 class Product(Base):
@@ -31,15 +48,15 @@ class Product(Base):
 class Order(Base):
     __tablename__ = 'orders'
     id        = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime, default=datetime.now)
+    timestamp = Column(DateTime, server_default=text("(datetime('now', 'localtime'))"))
     total     = Column(Float, default=0.0)
     items     = relationship('OrderItem', back_populates='order')
 
 class OrderItem(Base):
     __tablename__ = 'order_items'
     id         = Column(Integer, primary_key=True)
-    order_id   = Column(Integer, ForeignKey('orders.id'))
-    product_id = Column(Integer, ForeignKey('products.id'))
+    order_id   = Column(Integer, ForeignKey('orders.id'), index=True)
+    product_id = Column(Integer, ForeignKey('products.id'), index=True)
     quantity   = Column(Float, nullable=False)
     line_total = Column(Float, nullable=False)
     order      = relationship('Order', back_populates='items')
@@ -47,15 +64,35 @@ class OrderItem(Base):
 
 # Create tables + migrations
 Base.metadata.create_all(engine)
-inspector = inspect(engine)
-if 'orders' in inspector.get_table_names():
-    cols = [c['name'] for c in inspector.get_columns('orders')]
-    if 'total' not in cols:
-        with engine.connect() as conn:
+SCHEMA_VERSION = 2
+with engine.begin() as conn:
+    # user_version is bumped once migrated, so warm starts skip reflection
+    version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+    if version < 1:
+        cols = [c['name'] for c in inspect(conn).get_columns('orders')]
+        if 'total' not in cols:
             conn.execute(text('ALTER TABLE orders ADD COLUMN total FLOAT DEFAULT 0.0'))
+        # create_all() skips indexes on tables that already exist
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_order_items_order_id ON order_items(order_id)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_order_items_product_id ON order_items(product_id)'))
+    if version < 2:
+        # SQLite can't alter a column default, so rebuild orders with the server-side timestamp
+        ts = next(c for c in inspect(conn).get_columns('orders') if c['name'] == 'timestamp')
+        if ts['default'] is None:
+            # pysqlite doesn't wrap DDL in a transaction, so make the rebuild atomic explicitly
+            conn.exec_driver_sql('BEGIN')
+            conn.execute(text('DROP TABLE IF EXISTS orders_new'))
+            conn.execute(text("CREATE TABLE orders_new (id INTEGER NOT NULL, "
+                              "timestamp DATETIME DEFAULT (datetime('now', 'localtime')), "
+                              "total FLOAT DEFAULT 0.0, PRIMARY KEY (id))"))
+            conn.execute(text('INSERT INTO orders_new (id, timestamp, total) SELECT id, timestamp, total FROM orders'))
+            conn.execute(text('DROP TABLE orders'))
+            conn.execute(text('ALTER TABLE orders_new RENAME TO orders'))
+            conn.exec_driver_sql('COMMIT')
+    if version < SCHEMA_VERSION:
+        conn.exec_driver_sql(f'PRAGMA user_version={SCHEMA_VERSION}')
 
 # Seed default products
-session = Session()
 def_products = [
     ("Milk (per kg)",   150.0),
     ("Yogurt (per kg)", 200.0),
@@ -65,31 +102,49 @@ def_products = [
     ("Rice Pudding",     90.0),
     ("Desi Ghee (250g)",250.0)
 ]
-if session.query(Product).count() == 0:
-    for name, price in def_products:
-        session.add(Product(name=name, price_per_unit=price, stock=100.0))
-    session.commit()
+with Session() as s:
+    if s.query(Product).count() == 0:
+        s.execute(insert(Product),
+                  [{"name": name, "price_per_unit": price, "stock": 100.0} for name, price in def_products])
+        s.commit()
 
 # Receipt utility
+LINE_FMT = "{name:15s} {qty:>5.2f} × {price:>6.2f} = {total:>7.2f}".format
+
+def _write_receipt(path, body):
+    with open(path, 'wb') as f:
+        f.write(body.encode('utf-8'))
+
 def save_receipt(order):
     lines = ["*** MILK SHOP RECEIPT ***",
              f"Order #{order.id}   {order.timestamp:%Y-%m-%d %H:%M:%S}",
              '-'*40]
     for item in order.items:
-        lines.append(f"{item.product.name:15s} {item.quantity:>5.2f} × {item.product.price_per_unit:>6.2f} = {item.line_total:>7.2f}")
+        lines.append(LINE_FMT(name=item.product.name, qty=item.quantity,
+                              price=item.product.price_per_unit, total=item.line_total))
     lines += ['-'*40, f"TOTAL: {order.total:.2f}", 'Thank you!']
+    body = '\n'.join(lines)
     path = os.path.join(RECEIPT_DIR, f'receipt_{order.id}.txt')
-    with open(path, 'w') as f:
-        f.write('\n'.join(lines))
-    messagebox.showinfo("Receipt", "\n".join(lines))
+    # write off the Tk thread; not a daemon so a quick exit can't drop the receipt
+    threading.Thread(target=_write_receipt, args=(path, body)).start()
+    # non-modal, so the next sale can start while the receipt is shown
+    win = tb.Toplevel(title="Receipt")
+    txt = tk.Text(win, font=('Courier',11), width=48, height=len(lines))
+    txt.insert('1.0', body)
+    txt.config(state='disabled')
+    txt.pack(fill='both', expand=True, padx=10, pady=10)
+    # Enter closes the receipt and must not fall through to the app-wide checkout binding
+    for seq in ('<Escape>', '<Return>', '<KP_Enter>'):
+        win.bind(seq, lambda e: (win.destroy(), "break")[1])
+    win.focus_set()
 
 # Main POS Application with ttkbootstrap
 class POSApp(tb.Window):
     def __init__(self):
         super().__init__(themename="superhero", title="Milk Shop POS")
-        self.session = session
+        self.session = ReadSession
         self.cart    = {}
-        self.cart_keys = []
+        self._repaint_pending = False
         # bind Enter for checkout
         self.bind_all('<Return>', lambda e: self._checkout())
         # Build UI
@@ -106,18 +161,22 @@ class POSApp(tb.Window):
         self._build_sale_tab()
 
     def _build_products_tab(self):
-        for w in self.prod_frame.winfo_children(): w.destroy()
         cols = ("ID","Name","Price","Stock")
         self.prod_tree = tb.Treeview(self.prod_frame, columns=cols, show='headings')
         for c in cols: self.prod_tree.heading(c, text=c)
         self.prod_tree.pack(fill='both', expand=True, pady=5)
-        for p in self.session.query(Product).order_by(Product.name):
-            self.prod_tree.insert('', 'end', values=(p.id, p.name, f"{p.price_per_unit:.2f}", f"{p.stock:.2f}"))
         btns = tb.Frame(self.prod_frame)
         tb.Button(btns, text="Add/Update", bootstyle="success", command=self._add_product).pack(side='left', padx=5)
         tb.Button(btns, text="Delete",     bootstyle="warning", command=self._delete_product).pack(side='left', padx=5)
-        tb.Button(btns, text="Refresh",    bootstyle="info",    command=self._build_products_tab).pack(side='left')
+        tb.Button(btns, text="Refresh",    bootstyle="info",    command=self._refresh_products).pack(side='left')
         btns.pack(pady=5)
+        self._refresh_products()
+
+    def _refresh_products(self):
+        # keep the tree widget, only swap its rows
+        self.prod_tree.delete(*self.prod_tree.get_children())
+        for p in self.session.query(Product).order_by(Product.name):
+            self.prod_tree.insert('', 'end', iid=p.id, values=(p.id, p.name, f"{p.price_per_unit:.2f}", f"{p.stock:.2f}"))
 
     def _add_product(self):
         name = simpledialog.askstring("Name","Product name:", parent=self)
@@ -128,14 +187,16 @@ class POSApp(tb.Window):
         except:
             messagebox.showerror("Error","Invalid input")
             return
-        prod = self.session.query(Product).filter_by(name=name).first()
-        if prod:
-            prod.price_per_unit, prod.stock = price, stock
-        else:
-            prod = Product(name=name, price_per_unit=price, stock=stock)
-            self.session.add(prod)
-        self.session.commit()
-        self._build_products_tab()
+        with Session() as s:
+            prod = s.query(Product).filter_by(name=name).first()
+            if prod:
+                prod.price_per_unit, prod.stock = price, stock
+            else:
+                s.add(Product(name=name, price_per_unit=price, stock=stock))
+            s.commit()
+        self.session.expire_all()
+        self._refresh_products()
+        self._build_sale_buttons()
 
     def _delete_product(self):
         selected = self.prod_tree.focus()
@@ -146,22 +207,21 @@ class POSApp(tb.Window):
         pid = int(values[0])
         prod = self.session.get(Product, pid)
         if messagebox.askyesno("Confirm","Delete product '%s'?" % prod.name):
-            self.session.delete(prod)
-            self.session.commit()
-            self._build_products_tab()
+            with Session() as s:
+                s.delete(s.get(Product, pid))
+                s.commit()
+            self.session.expire_all()
+            self._refresh_products()
+            self._build_sale_buttons()
+            if self.cart.pop(pid, None) is not None:
+                self.update_cart_display()
 
     def _build_sale_tab(self):
         for w in self.sale_frame.winfo_children(): w.destroy()
-        btn_frame = tb.Frame(self.sale_frame)
-        btn_frame.pack(side='left', fill='y', padx=10, pady=10)
-        products = self.session.query(Product).order_by(Product.name).all()
-        for idx, p in enumerate(products):
-            variants = [(0.5,'½kg'),(1.0,'1kg')] if 'per kg' in p.name else [(1,'')]
-            for col,(q,label) in enumerate(variants):
-                text = f"{p.name}\n{label or '1'}"
-                btn = tb.Button(btn_frame, text=text, width=16, bootstyle="primary",
-                                command=lambda p=p,qty=q: self.add_to_cart(p,qty))
-                btn.grid(row=idx, column=col, pady=5, padx=5)
+        self.sale_btn_frame = tb.Frame(self.sale_frame)
+        self.sale_btn_frame.pack(side='left', fill='y', padx=10, pady=10)
+        self._sale_sig = None
+        self._build_sale_buttons()
         cart_frame = tb.Frame(self.sale_frame)
         cart_frame.pack(side='right', fill='both', expand=True, padx=10, pady=10)
         tb.Label(cart_frame, text='Cart:', font=('Arial',14)).pack(anchor='w')
@@ -175,20 +235,46 @@ class POSApp(tb.Window):
         tb.Button(action_frame, text='Checkout (Enter)', bootstyle='danger', command=self._checkout).pack(side='left', padx=5)
         action_frame.pack(pady=5)
 
+    def _build_sale_buttons(self):
+        products = self.session.query(Product).order_by(Product.name).all()
+        self._prod_cache = {p.id: p for p in products}
+        sig = tuple((p.id, p.name) for p in products)
+        if sig == self._sale_sig:
+            # same products: rebind the existing buttons instead of recreating them
+            for btn, pid, q in self._sale_buttons:
+                btn.configure(command=lambda p=self._prod_cache[pid],qty=q: self.add_to_cart(p,qty))
+            return
+        self._sale_sig = sig
+        self._variants = {p.id: [(0.5,'½kg'),(1.0,'1kg')] if 'per kg' in p.name else [(1,'')] for p in products}
+        for w in self.sale_btn_frame.winfo_children(): w.destroy()
+        self._sale_buttons = []
+        for idx, p in enumerate(products):
+            for col,(q,label) in enumerate(self._variants[p.id]):
+                text = f"{p.name}\n{label or '1'}"
+                btn = tb.Button(self.sale_btn_frame, text=text, width=16, bootstyle="primary",
+                                command=lambda p=p,qty=q: self.add_to_cart(p,qty))
+                btn.grid(row=idx, column=col, pady=5, padx=5)
+                self._sale_buttons.append((btn, p.id, q))
+
     def add_to_cart(self, product, qty):
         self.cart[product.id] = self.cart.get(product.id, 0) + qty
+        # coalesce a burst of clicks into a single repaint
+        if not self._repaint_pending:
+            self._repaint_pending = True
+            self.after_idle(self._do_repaint)
+
+    def _do_repaint(self):
+        self._repaint_pending = False
         self.update_cart_display()
 
     def update_cart_display(self):
         self.cart_listbox.delete(0, tk.END)
-        self.cart_keys = []
         total = 0.0
         for pid, qty in self.cart.items():
-            p = self.session.get(Product, pid)
+            p = self._prod_cache[pid]
             line = p.price_per_unit * qty
             total += line
             self.cart_listbox.insert(tk.END, f"{p.name}: {qty} x {p.price_per_unit:.2f} = {line:.2f}")
-            self.cart_keys.append(pid)
         self.total_lbl.config(text=f"Total: {total:.2f}")
 
     def _remove_selected(self):
@@ -197,7 +283,8 @@ class POSApp(tb.Window):
             messagebox.showwarning("Warning","No item selected to remove")
             return
         idx = sel[0]
-        pid = self.cart_keys[idx]
+        # listbox rows follow the cart's insertion order
+        pid = next(islice(self.cart, idx, None))
         del self.cart[pid]
         self.update_cart_display()
 
@@ -210,25 +297,41 @@ class POSApp(tb.Window):
         if not self.cart:
             messagebox.showinfo("Info","No items selected")
             return
-        order = Order()
-        self.session.add(order)
-        self.session.commit()
-        total = 0.0
+        # validate all stock up front so a failed sale never touches the database
         for pid, qty in self.cart.items():
-            p = self.session.get(Product, pid)
+            p = self._prod_cache[pid]
             if p.stock < qty:
                 messagebox.showerror("Error",f"Not enough stock for {p.name}")
                 return
-            line = p.price_per_unit * qty
-            total += line
-            p.stock -= qty
-            item = OrderItem(order_id=order.id, product_id=pid, quantity=qty, line_total=line)
-            self.session.add(item)
-        order.total = total
-        self.session.commit()
+        with Session() as s:
+            with s.begin():
+                total = 0.0
+                items, updates = [], []
+                prods = {p.id: p for p in s.query(Product).filter(Product.id.in_(self.cart)).all()}
+                for pid, qty in self.cart.items():
+                    p = prods[pid]
+                    line = p.price_per_unit * qty
+                    total += line
+                    updates.append({"id": pid, "stock": p.stock - qty})
+                    items.append({"product_id": pid, "quantity": qty, "line_total": line})
+                # total is known up front, so the order is a single INSERT
+                order = Order(total=total)
+                s.add(order)
+                s.flush()
+                order_id = order.id
+                for item in items:
+                    item["order_id"] = order_id
+                s.bulk_insert_mappings(OrderItem, items)
+                s.bulk_update_mappings(Product, updates)
+            order = s.get(Order, order_id, populate_existing=True,
+                          options=[selectinload(Order.items).joinedload(OrderItem.product)])
         save_receipt(order)
         self.cart.clear()
-        self._build_products_tab()
+        # only the purchased rows changed: patch the cached products and the
+        # tree rows (keyed by product id) instead of expiring and reloading
+        for u in updates:
+            set_committed_value(self._prod_cache[u["id"]], 'stock', u["stock"])
+            self.prod_tree.set(u["id"], "Stock", f"{u['stock']:.2f}")
         self.update_cart_display()
 
 if __name__ == '__main__':